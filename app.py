@@ -1,12 +1,17 @@
+import bisect
 import os
+import queue
 import re
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime, UTC
-from difflib import SequenceMatcher
 from functools import wraps
 
 from flask import (Flask, flash, g, redirect, render_template,
                    request, session, url_for)
+from markupsafe import Markup, escape
+from rapidfuzz.distance import Indel
 from werkzeug.security import check_password_hash, generate_password_hash
 
 import pathlib
@@ -21,13 +26,48 @@ DB_PATH = os.environ.get("POEM_DB", "poem.db")
 
 # ── DB helpers ─────────────────────────────────────────────────────────────────
 
+# WAL lets readers proceed during writes; NORMAL sync is safe under WAL and
+# avoids an fsync per commit.
+_PRAGMAS = (
+    "journal_mode = WAL",
+    "synchronous = NORMAL",
+    "temp_store = MEMORY",
+    "busy_timeout = 30000",
+    "cache_size = -20000",
+    "foreign_keys = ON",
+)
+
+# Connections are reused across requests so SQLite's page cache survives.
+# They run in autocommit mode; routes group their writes with transaction().
+_pool = queue.LifoQueue(maxsize=8)
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False,
+                           cached_statements=256, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    return conn
+
 def get_db():
     if "db" not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
-        g.db.execute("PRAGMA foreign_keys = ON")
+        try:
+            g.db = _pool.get_nowait()
+        except queue.Empty:
+            g.db = _connect()
     return g.db
 
+@contextmanager
+def transaction(db):
+    """Run the block inside BEGIN IMMEDIATE … COMMIT, rolling back on error."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
 def get_available_translations():
     # Get available translations
     db = get_db()
@@ -45,13 +85,24 @@ def inject_globals():
 @app.teardown_appcontext
 def close_db(e=None):
     db = g.pop("db", None)
-    if db:
+    if db is None:
+        return
+    if db.in_transaction:
+        db.rollback()
+    try:
+        _pool.put_nowait(db)
+    except queue.Full:
         db.close()
 
 
-def init_db():
+def _has_table(db, name):
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+
+def init_db(db):
     """Create the application-specific tables if they don't exist yet."""
-    db = get_db()
     db.executescript("""
         CREATE TABLE IF NOT EXISTS users (
             id            INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -78,10 +129,23 @@ def init_db():
             verse_id     INTEGER NOT NULL REFERENCES verses(id),
             user_input   TEXT    NOT NULL,
             similarity   REAL    NOT NULL,  -- 0.0-1.0
+            diff_html    TEXT,              -- rendered at attempt time
             attempted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
+
+        CREATE INDEX IF NOT EXISTS idx_va_session
+            ON verse_attempts(session_id);
+        CREATE INDEX IF NOT EXISTS idx_ms_user_chapter_completed
+            ON memorization_sessions(user_id, chapter_id, completed_at DESC);
     """)
-    db.commit()
+    # The one index the app adds to the imported verses table, for verse_page
+    if _has_table(db, "verses"):
+        db.execute("CREATE INDEX IF NOT EXISTS idx_verses_chapter_number"
+                   " ON verses(chapter_id, number)")
+    # Databases created before diff_html was stored need the column added
+    columns = {row["name"] for row in db.execute("PRAGMA table_info(verse_attempts)")}
+    if "diff_html" not in columns:
+        db.execute("ALTER TABLE verse_attempts ADD COLUMN diff_html TEXT")
 
 
 # ── Auth helpers ───────────────────────────────────────────────────────────────
@@ -100,78 +164,103 @@ def current_user():
     if "user_id" not in session:
         return None
     return get_db().execute(
-        "SELECT * FROM users WHERE id = ?", (session["user_id"],)
+        "SELECT id, username, created_at FROM users WHERE id = ?", (session["user_id"],)
     ).fetchone()
 
 
 # ── Text comparison helpers ────────────────────────────────────────────────────
+# Single translate table for normalize_arabic_text (one C-level pass).
+_AR_TRANS = {
+    0x0670: 0x0627,  # superscript alif → regular alif
+    0x0640: None,    # Arabic tatweel ("ـ")
+    0x0671: 0x0627,  # Alef Wasla (ٱ) → regular alif (ا)
+    0x06E5: None,    # small waw
+    0x06E2: None,    # small high meem isolated form
+    **{c: None for c in range(0x064B, 0x0656)},  # diacritics U+064B–U+0655
+}
+_WS_RE = re.compile(r"\s+")
+
+
 def normalize_arabic_text(text):
-    # Replace superscript alif (U+0670) with regular alif
-    text = text.replace('\u0670', 'ا')
-    # Remove U+0640 "ARABIC Tatweel" ("ـ").
-    text = text.replace('\u0640', '')
-    # Replace Alef Wasla (ٱ) with regular Alif (ا)
-    text = text.replace('\u0671', '\u0627')
-    # Remove small waw (U+06E5)
-    text = text.replace('\u06E5', '')
-    # Remove small high meem isolated form (U+06E2)
-    text = text.replace('\u06E2', '')
-    # Remove Arabic diacritics (U+064B to U+0655)
-    arabic_diacritics = re.compile(r'[\u064B-\u0655]')
-    text = arabic_diacritics.sub('', text)
-    return text
+    return text.translate(_AR_TRANS)
 
 def normalize(text: str) -> str:
-    return re.sub(r"\s+", " ", normalize_arabic_text(text.strip()))
+    return _WS_RE.sub(" ", normalize_arabic_text(text.strip()))
 
 
-def similarity_score(expected: str, user_input: str) -> float:
-    """Returns 0.0–1.0 similarity (word-level, case-insensitive)."""
-    a = normalize(expected).lower().split()
-    b = normalize(user_input).lower().split()
-    if not a:
-        return 1.0
-    return SequenceMatcher(None, a, b).ratio()
+# Normalized words paired with their lowercased form: the lowercased tuple is
+# what gets matched, the original is what the diff displays.
+Words = tuple[tuple[str, ...], tuple[str, ...]]
 
+def _split_words(text: str) -> Words:
+    words = tuple(normalize(text).split())
+    return words, tuple(w.lower() for w in words)
 
-def build_diff_html(expected: str, user_input: str) -> str:
+
+# Normalized words per verse id; the app never edits verses, so this is
+# filled once at startup (and lazily for verses it hasn't seen yet).
+VERSE_NORM: dict[int, Words] = {}
+
+def load_verse_norm(db):
+    VERSE_NORM.clear()
+    if not _has_table(db, "verses"):
+        return
+    for row in db.execute("SELECT id, content FROM verses"):
+        VERSE_NORM[row["id"]] = _split_words(row["content"])
+
+def verse_words(verse_id: int, content: str) -> Words:
+    words = VERSE_NORM.get(verse_id)
+    if words is None:
+        words = VERSE_NORM[verse_id] = _split_words(content)
+    return words
+
+
+_OK    = '<span class="diff-ok">{}</span>'
+_MISS  = '<span class="diff-missing">{}</span>'
+_EXTRA = '<span class="diff-extra">{}</span>'
+
+def score_and_diff(expected: Words, user_input: str) -> tuple[float, Markup]:
     """
-    Returns an HTML snippet where:
+    Returns (similarity, diff_html) for one attempt, given the expected
+    verse's normalized words (see verse_words). Words are HTML-escaped, so
+    diff_html is returned as Markup.
+
+    similarity is 0.0–1.0 (word-level, case-insensitive); diff_html is an
+    HTML snippet where:
       • correct words  → green
       • missing words  → red   (what was expected but not typed)
       • extra words    → amber (what was typed but not expected)
     """
-    a = normalize(expected).split()
-    b = normalize(user_input).split()
-    parts = []
-    for tag, i1, i2, j1, j2 in SequenceMatcher(None,
-                                                 [w.lower() for w in a],
-                                                 [w.lower() for w in b]).get_opcodes():
+    a, al = expected
+    b, bl = _split_words(user_input)
+    if al == bl:
+        return 1.0, Markup(" ".join(_OK.format(escape(w)) for w in a))
+    # One LCS alignment gives both the score and the diff. Indel emits
+    # insertions before deletions, so each gap between matches is buffered
+    # and rendered missing-before-extra.
+    parts, missing, extra = [], [], []
+    matched = 0
+    for tag, i1, i2, j1, j2 in Indel.opcodes(al, bl):
         if tag == "equal":
-            parts += [f'<span class="diff-ok">{w}</span>' for w in a[i1:i2]]
-        elif tag == "replace":
-            parts += [f'<span class="diff-missing">{w}</span>' for w in a[i1:i2]]
-            parts += [f'<span class="diff-extra">{w}</span>'   for w in b[j1:j2]]
-        elif tag == "delete":
-            parts += [f'<span class="diff-missing">{w}</span>' for w in a[i1:i2]]
-        elif tag == "insert":
-            parts += [f'<span class="diff-extra">{w}</span>'   for w in b[j1:j2]]
-    return " ".join(parts)
+            parts += missing + extra
+            missing, extra = [], []
+            parts.extend(_OK.format(escape(w)) for w in a[i1:i2])
+            matched += i2 - i1
+        else:
+            missing.extend(_MISS.format(escape(w)) for w in a[i1:i2])
+            extra.extend(_EXTRA.format(escape(w)) for w in b[j1:j2])
+    parts += missing + extra
+    score = 2 * matched / (len(a) + len(b)) if a else 1.0
+    return score, Markup(" ".join(parts))
+
 
+# Lower bounds of each grade band; _GRADES[i] covers [_THRESHOLDS[i-1], _THRESHOLDS[i]).
+_THRESHOLDS = [60, 70, 73, 77, 80, 83, 87, 90, 93, 97]
+_GRADES     = ["F", "D", "C−", "C", "C+", "B−", "B", "B+", "A−", "A", "A+"]
 
 def score_to_grade(score: float) -> str:
     """Convert 0-100 score to letter grade."""
-    if score >= 97: return "A+"
-    if score >= 93: return "A"
-    if score >= 90: return "A−"
-    if score >= 87: return "B+"
-    if score >= 83: return "B"
-    if score >= 80: return "B−"
-    if score >= 77: return "C+"
-    if score >= 73: return "C"
-    if score >= 70: return "C−"
-    if score >= 60: return "D"
-    return "F"
+    return _GRADES[bisect.bisect_right(_THRESHOLDS, score)]
 
 
 def grade_color(grade: str) -> str:
@@ -191,16 +280,20 @@ def register():
         db = get_db()
         if not username or not password:
             flash("Username and password are required.", "danger")
-        elif db.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone():
-            flash("Username already taken.", "danger")
         else:
-            db.execute(
-                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                (username, generate_password_hash(password)),
-            )
-            db.commit()
-            flash("Account created! Please log in.", "success")
-            return redirect(url_for("login"))
+            password_hash = generate_password_hash(password)
+            # The UNIQUE constraint on username rejects duplicates atomically
+            try:
+                with transaction(db):
+                    db.execute(
+                        "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                        (username, password_hash),
+                    )
+            except sqlite3.IntegrityError:
+                flash("Username already taken.", "danger")
+            else:
+                flash("Account created! Please log in.", "success")
+                return redirect(url_for("login"))
     return render_template("register.html")
 
 
@@ -211,7 +304,7 @@ def login():
         password = request.form["password"]
         db = get_db()
         user = db.execute(
-            "SELECT * FROM users WHERE username = ?", (username,)
+            "SELECT id, username, password_hash FROM users WHERE username = ?", (username,)
         ).fetchone()
         if user and check_password_hash(user["password_hash"], password):
             session.clear()
@@ -237,7 +330,7 @@ def index():
     selected_translation = request.args.get('translation', None)
     db = get_db()
     chapters = db.execute(
-        'SELECT * FROM chapters ORDER BY 1'
+        'SELECT id, name, "order", type, verse_count FROM chapters ORDER BY 1'
     ).fetchall()
     translations = get_available_translations()
     return render_template("index.html", chapters=chapters, translations=translations, selected_translation=selected_translation)
@@ -251,23 +344,26 @@ def start_session(chapter_id):
     selected_translation = request.args.get('translation', None)
 
     db = get_db()
-    chapter = db.execute("SELECT * FROM chapters WHERE id = ?", (chapter_id,)).fetchone()
+    chapter = db.execute("SELECT id FROM chapters WHERE id = ?", (chapter_id,)).fetchone()
     if not chapter:
         flash("Chapter not found.", "danger")
         return redirect(url_for("index"))
 
     # Create a new memorization session
-    cur = db.execute(
-        "INSERT INTO memorization_sessions (user_id, chapter_id) VALUES (?, ?)",
-        (session["user_id"], chapter_id),
-    )
-    db.commit()
+    with transaction(db):
+        cur = db.execute(
+            "INSERT INTO memorization_sessions (user_id, chapter_id) VALUES (?, ?)",
+            (session["user_id"], chapter_id),
+        )
     mem_session_id = cur.lastrowid
 
     # Store progress in Flask session
     session["mem_session_id"] = mem_session_id
     session["chapter_id"]     = chapter_id
     session["verse_index"]    = 0          # index into the ordered verse list
+    session["verse_count"]    = db.execute(
+        "SELECT COUNT(*) FROM verses WHERE chapter_id = ?", (chapter_id,)
+    ).fetchone()[0]
 
     if selected_translation:
         return redirect(url_for("verse_page", translation=selected_translation))
@@ -286,18 +382,29 @@ def verse_page():
     
     selected_translation = request.args.get('translation', None)
     
-    chapter   = db.execute("SELECT * FROM chapters WHERE id = ?", (session["chapter_id"],)).fetchone()
-    verses    = db.execute(
-        "SELECT * FROM verses WHERE chapter_id = ? ORDER BY number",
-        (session["chapter_id"],),
-    ).fetchall()
+    chapter   = db.execute("SELECT id, name FROM chapters WHERE id = ?", (session["chapter_id"],)).fetchone()
     idx       = session["verse_index"]
-
-    if idx >= len(verses):
+    verse_count = session.get("verse_count")
+    if verse_count is None:
+        # Sessions started before verse_count was stored
+        verse_count = session["verse_count"] = db.execute(
+            "SELECT COUNT(*) FROM verses WHERE chapter_id = ?", (session["chapter_id"],)
+        ).fetchone()[0]
+
+    if idx >= verse_count:
         return redirect(url_for("report"))
 
-    verse     = verses[idx]
-    prev_verse = verses[idx - 1] if idx > 0 else None
+    # Fetch only the current verse, plus the previous one as a hint
+    rows      = db.execute(
+        """SELECT id, number, content FROM verses
+           WHERE chapter_id = ? ORDER BY number LIMIT ? OFFSET ?""",
+        (session["chapter_id"], 2 if idx > 0 else 1, max(idx - 1, 0)),
+    ).fetchall()
+    if len(rows) < (2 if idx > 0 else 1):
+        # The chapter has fewer verses than counted (e.g. it was re-imported)
+        return redirect(url_for("report"))
+    verse     = rows[-1]
+    prev_verse = rows[0] if idx > 0 else None
 
     translated_verse = None
     if selected_translation:
@@ -322,24 +429,23 @@ def verse_page():
             else:
                 return redirect(url_for("verse_page"))
 
-        sim        = similarity_score(verse["content"], user_input)
+        sim, diff_html = score_and_diff(verse_words(verse["id"], verse["content"]), user_input)
         score_pct  = round(sim * 100, 1)
 
-        db.execute(
-            """INSERT INTO verse_attempts (session_id, verse_id, user_input, similarity)
-               VALUES (?, ?, ?, ?)""",
-            (session["mem_session_id"], verse["id"], user_input, sim),
-        )
-        db.commit()
+        with transaction(db):
+            db.execute(
+                """INSERT INTO verse_attempts (session_id, verse_id, user_input, similarity, diff_html)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (session["mem_session_id"], verse["id"], user_input, sim, str(diff_html)),
+            )
 
-        diff_html   = build_diff_html(verse["content"], user_input)
         verse_score = score_pct
 
         return render_template(
             "verse.html",
             chapter=chapter,
             verse=verse,
-            verses=verses,
+            verse_count=verse_count,
             idx=idx,
             prev_verse=prev_verse,
             diff_html=diff_html,
@@ -358,9 +464,8 @@ def verse_page():
         
         if user_input_param and show_result:
             # Reconstruct the diff from the saved input
-            sim = similarity_score(verse["content"], user_input_param)
+            sim, diff_html = score_and_diff(verse_words(verse["id"], verse["content"]), user_input_param)
             score_pct = round(sim * 100, 1)
-            diff_html = build_diff_html(verse["content"], user_input_param)
             verse_score = score_pct
             user_input = user_input_param
         else:
@@ -370,7 +475,7 @@ def verse_page():
         "verse.html",
         chapter=chapter,
         verse=verse,
-        verses=verses,
+        verse_count=verse_count,
         idx=idx,
         prev_verse=prev_verse,
         diff_html=diff_html,
@@ -391,44 +496,53 @@ def report():
 
     db         = get_db()
     mem_sid    = session["mem_session_id"]
-    chapter    = db.execute("SELECT * FROM chapters WHERE id = ?", (session["chapter_id"],)).fetchone()
+    chapter    = db.execute("SELECT id, name FROM chapters WHERE id = ?", (session["chapter_id"],)).fetchone()
 
-    attempts = db.execute(
-        """SELECT va.*, v.content AS expected, v.number
-           FROM verse_attempts va
-           JOIN verses v ON v.id = va.verse_id
-           WHERE va.session_id = ?
-           ORDER BY v.number""",
-        (mem_sid,),
-    ).fetchall()
+    avg = db.execute(
+        "SELECT AVG(similarity) FROM verse_attempts WHERE session_id = ?", (mem_sid,)
+    ).fetchone()[0]
 
-    if not attempts:
+    if avg is None:
         flash("No attempts found.", "warning")
         return redirect(url_for("index"))
 
-    avg_score = round(sum(a["similarity"] for a in attempts) / len(attempts) * 100, 1)
+    avg_score = round(avg * 100, 1)
     grade     = score_to_grade(avg_score)
 
     # Finalise the session row
-    db.execute(
-        """UPDATE memorization_sessions
-           SET completed_at = ?, total_score = ?, grade = ?
-           WHERE id = ?""",
-        (datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S"), avg_score, grade, mem_sid),
-    )
-    db.commit()
+    with transaction(db):
+        db.execute(
+            """UPDATE memorization_sessions
+               SET completed_at = ?, total_score = ?, grade = ?
+               WHERE id = ?""",
+            (datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S"), avg_score, grade, mem_sid),
+        )
 
-    # Build per-verse diff
-    diffs = [
-        {
+    # Per-verse diff, rendered when the attempt was made
+    attempts = db.execute(
+        """SELECT va.verse_id, va.user_input, va.similarity, va.diff_html,
+                  v.content AS expected, v.number
+           FROM verse_attempts va
+           JOIN verses v ON v.id = va.verse_id
+           WHERE va.session_id = ?
+           ORDER BY v.number""",
+        (mem_sid,),
+    ).fetchall()
+    diffs = []
+    for a in attempts:
+        if a["diff_html"]:
+            diff_html = Markup(a["diff_html"])
+        else:
+            # Attempts saved before diffs were stored
+            expected  = verse_words(a["verse_id"], a["expected"])
+            diff_html = score_and_diff(expected, a["user_input"])[1]
+        diffs.append({
             "number":     a["number"],
             "expected":   a["expected"],
             "user_input": a["user_input"],
             "score":      round(a["similarity"] * 100, 1),
-            "diff_html":  build_diff_html(a["expected"], a["user_input"]),
-        }
-        for a in attempts
-    ]
+            "diff_html":  diff_html,
+        })
 
     # History for this user / chapter
     history = db.execute(
@@ -441,7 +555,7 @@ def report():
     ).fetchall()
 
     # Clear session state
-    for key in ("mem_session_id", "chapter_id", "verse_index"):
+    for key in ("mem_session_id", "chapter_id", "verse_index", "verse_count"):
         session.pop(key, None)
 
     return render_template(
@@ -457,8 +571,44 @@ def report():
 
 # ── Bootstrap ──────────────────────────────────────────────────────────────────
 
+def bootstrap():
+    """Create the app's tables and fill VERSE_NORM.
+
+    Uses its own connection, closed afterwards, so nothing opened here ends
+    up in _pool (and is never shared with forked workers).
+    """
+    db = _connect()
+    try:
+        init_db(db)
+        load_verse_norm(db)
+    finally:
+        db.close()
+
+
+# Run once per process, on its first request, for both `flask run` and
+# `python app.py`. Doing this at import time would break imports against a
+# database without the poem tables and leak a connection into pre-forked
+# workers.
+_bootstrapped = False
+_bootstrap_lock = threading.Lock()
+
+@app.before_request
+def ensure_bootstrapped():
+    global _bootstrapped
+    if _bootstrapped:
+        return
+    with _bootstrap_lock:
+        if not _bootstrapped:
+            bootstrap()
+            _bootstrapped = True
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the application tables without starting the server."""
+    bootstrap()
+    print("Database initialised.")
+
 if __name__ == "__main__":
-    with app.app_context():
-        init_db()
     #app.run(debug=True)
     app.run(debug=True, host='0.0.0.0', port=5000)